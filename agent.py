@@ -1,11 +1,30 @@
 from stable_baselines3 import PPO
-from stable_baselines3.common.vec_env import DummyVecEnv
+from stable_baselines3.common.vec_env import VecMonitor
 from stable_baselines3.common.evaluation import evaluate_policy
 import numpy as np
+import torch
+import copy
 import json
-from environment import SmartPillboxEnv
+from datetime import timedelta
+from environment import VectorizedSmartPillboxEnv
 import os
 
+class DeterministicActor(torch.nn.Module):
+    """
+    Camino determinista de la política PPO (extractor de características,
+    red del actor y capa de acción) empaquetado para torch.jit.trace
+    """
+    
+    def __init__(self, policy):
+        super(DeterministicActor, self).__init__()
+        self.features_extractor = policy.features_extractor
+        self.mlp_extractor = policy.mlp_extractor
+        self.action_net = policy.action_net
+    
+    def forward(self, observation):
+        features = self.features_extractor(observation)
+        return self.action_net(self.mlp_extractor.forward_actor(features))
+
 class SmartPillboxAgent:
     """
     Agente de RL para el pastillero inteligente usando Stable Baselines3
@@ -16,7 +35,9 @@ class SmartPillboxAgent:
         self.config = {
             'learning_rate': 0.0003,  # Tasa de aprendizaje
             'gamma': 0.99,            # Factor de descuento
-            'n_steps': 2048,          # Pasos por actualización
+            'n_steps': 2048,          # Pasos por actualización (total entre entornos)
+            'n_envs': 8,              # Entornos en paralelo para recolectar rollouts
+            'n_eval_envs': 10,        # Entornos en paralelo para la evaluación
             'ent_coef': 0.01,         # Coeficiente de entropía
             'log_dir': './logs/',     # Directorio para logs
             'save_dir': './models/'   # Directorio para guardar modelos
@@ -29,20 +50,47 @@ class SmartPillboxAgent:
         os.makedirs(self.config['log_dir'], exist_ok=True)
         os.makedirs(self.config['save_dir'], exist_ok=True)
         
-        # Crear entorno
-        self.env = DummyVecEnv([lambda: SmartPillboxEnv()])
+        # Crear entorno vectorizado: todos los entornos avanzan juntos como operaciones de NumPy
+        n_envs = self.config['n_envs']
+        self.env = VecMonitor(VectorizedSmartPillboxEnv(num_envs=n_envs))
         
-        # Inicializar modelo PPO
+        # Entorno de evaluación aparte: cada entorno corre un episodio en paralelo
+        self.eval_env = VecMonitor(VectorizedSmartPillboxEnv(num_envs=self.config['n_eval_envs']))
+        
+        # Inicializar modelo PPO (n_steps por entorno, mismo tamaño de rollout total)
         self.model = PPO(
             "MlpPolicy", 
             self.env, 
             learning_rate=self.config['learning_rate'],
             gamma=self.config['gamma'],
-            n_steps=self.config['n_steps'],
+            n_steps=max(1, self.config['n_steps'] // n_envs),
             ent_coef=self.config['ent_coef'],
             verbose=1,
             tensorboard_log=self.config['log_dir']
         )
+        self._trace_policy()
+    
+    def _trace_policy(self):
+        """
+        Compila la política con torch.jit.trace para inferencia sin el envoltorio de SB3.
+        Se traza una copia de los pesos: un entrenamiento en curso actualiza
+        self.model.policy en el lugar y no debe afectar a las predicciones, que
+        cambian a la nueva política solo al reasignar self.traced_policy
+        """
+        actor = copy.deepcopy(DeterministicActor(self.model.policy)).eval()
+        sample_obs = torch.zeros((1, *self.env.observation_space.shape), device=self.model.device)
+        with torch.no_grad():
+            self.traced_policy = torch.jit.trace(actor, sample_obs)
+    
+    def _predict_actions(self, observations):
+        """Predice acciones deterministas para un lote de observaciones de forma (B, 3)"""
+        traced_policy = self.traced_policy  # Una sola referencia, aunque un entrenamiento la reemplace
+        with torch.no_grad():
+            obs_tensor = torch.as_tensor(observations, device=self.model.device)
+            actions = traced_policy(obs_tensor).cpu().numpy()
+        
+        # Igual que model.predict: recortar al rango del espacio de acciones
+        return np.clip(actions, self.env.action_space.low, self.env.action_space.high)
     
     def train(self, total_timesteps=100000):
         """
@@ -52,6 +100,7 @@ class SmartPillboxAgent:
             total_timesteps: Número total de pasos de entrenamiento
         """
         self.model.learn(total_timesteps=total_timesteps)
+        self._trace_policy()
         
         # Guardar el modelo entrenado
         model_path = os.path.join(self.config['save_dir'], "pillbox_ppo")
@@ -68,6 +117,7 @@ class SmartPillboxAgent:
             model_path: Ruta al modelo guardado
         """
         self.model = PPO.load(model_path, env=self.env)
+        self._trace_policy()
         print(f"Modelo cargado desde {model_path}")
     
     def evaluate(self, n_eval_episodes=10):
@@ -83,7 +133,7 @@ class SmartPillboxAgent:
         """
         mean_reward, std_reward = evaluate_policy(
             self.model, 
-            self.env, 
+            self.eval_env, 
             n_eval_episodes=n_eval_episodes
         )
         
@@ -109,15 +159,47 @@ class SmartPillboxAgent:
         # Calcular factor de historial (promedio de cumplimiento reciente)
         history_factor = np.mean(history) if history else 0.5
         
-        # Observación inicial (sin diferencia de tiempo al inicio)
-        observation = np.array([0, history_factor, current_hour], dtype=np.float32)
+        # Observación inicial (sin diferencia de tiempo al inicio), ya como lote de 1.
+        # Es local: el agente es compartido entre solicitudes concurrentes
+        observation = np.array([[0, history_factor, current_hour]], dtype=np.float32)
         
         # Predecir ajuste
-        action, _ = self.model.predict(observation, deterministic=True)
+        action = self._predict_actions(observation)[0]
         time_adjustment = float(action[0])
         
         # Aplicar ajuste
-        from datetime import timedelta
         adjusted_time = scheduled_time + timedelta(minutes=time_adjustment)
         
-        return adjusted_time, time_adjustment 
\ No newline at end of file
+        return adjusted_time, time_adjustment
+    
+    def adjust_schedule_batch(self, scheduled_times, histories):
+        """
+        Ajusta varios horarios con una sola predicción del modelo
+        
+        Args:
+            scheduled_times: Lista de tiempos programados originales
+            histories: Lista de historiales de tomas, uno por horario
+            
+        Returns:
+            Lista de tuplas (adjusted_time, time_adjustment), una por horario
+        """
+        if not scheduled_times:
+            return []
+        
+        # Una observación por horario: [diferencia_tiempo, histórico_cumplimiento, hora_del_día]
+        # (un solo arreglo por lote: /process llama en paralelo sin bloqueo, así que no se comparte)
+        observations = np.empty((len(scheduled_times), 3), dtype=np.float32)
+        observations[:, 0] = 0
+        observations[:, 1] = [np.mean(history) if history else 0.5 for history in histories]
+        observations[:, 2] = [
+            scheduled_time.hour + scheduled_time.minute / 60.0
+            for scheduled_time in scheduled_times
+        ]
+        
+        # Predecir todos los ajustes en un solo paso del modelo
+        actions = self._predict_actions(observations)
+        
+        return [
+            (scheduled_time + timedelta(minutes=float(action[0])), float(action[0]))
+            for scheduled_time, action in zip(scheduled_times, actions)
+        ]
@@ -1,57 +1,92 @@
 from flask import Flask, request, jsonify
-from data_processor import DataProcessor
+from data_processor import DataProcessor, parse_time, parse_log_times
 from agent import SmartPillboxAgent
-import json
+from environment import calculate_compliance
+import orjson
 import os
-from datetime import datetime, time, timedelta
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from datetime import datetime
 
 app = Flask(__name__)
 
-# Inicializar el procesador de datos y el agente
+MODEL_PATH = os.path.join('./models', 'pillbox_ppo')
+
+# Inicializar el procesador de datos y el agente (una sola instancia para todas las solicitudes)
 processor = DataProcessor()
-agent = None  # Se inicializará cuando se entrene el modelo
+agent = SmartPillboxAgent()
 
-def parse_time(time_str):
-    """Convierte una cadena de tiempo a datetime"""
-    if not time_str:
-        return datetime.now()
-        
-    try:
-        # Si es formato ISO con Z (UTC)
-        if 'T' in time_str and 'Z' in time_str:
-            time_str = time_str.replace('Z', '+00:00')
-            
-        # Si es solo hora (HH:MM:SS)
-        if len(time_str.split(':')) == 3 and 'T' not in time_str:
-            hour, minute, second = map(int, time_str.split(':'))
-            return datetime.combine(datetime.now().date(), time(hour, minute, second))
-            
-        # Si es fecha completa en formato ISO
-        dt = datetime.fromisoformat(time_str)
-        return dt.replace(tzinfo=None) if dt.tzinfo else dt
-        
-    except Exception as e:
-        print(f"Error al parsear tiempo: {time_str}, error: {str(e)}")
-        return datetime.now()
+# Cargar el modelo guardado, si existe, para no entrenar en cada solicitud
+agent_trained = os.path.exists(MODEL_PATH + '.zip')
+if agent_trained:
+    agent.load(MODEL_PATH)
+
+# El entrenamiento corre en segundo plano, un trabajo a la vez
+training_executor = ThreadPoolExecutor(max_workers=1)
+training_jobs = {}
+_jobs_lock = threading.Lock()  # Protege training_jobs entre solicitudes concurrentes
+MAX_TRAINING_JOBS = 100  # Trabajos (en cola o terminados) que se conservan para consulta
+# Máximo de pasos por entrenamiento que acepta /train (configurable por variable de entorno)
+MAX_TOTAL_TIMESTEPS = int(os.environ.get('MAX_TOTAL_TIMESTEPS', 1000000))
+
+# Campos requeridos por validate_medication_data
+_REQUIRED_MED_FIELDS = frozenset({'medication_id', 'start_date', 'interval', 'schedules'})
+_REQUIRED_SCHEDULE_FIELDS = frozenset({'schedule_id', 'scheduled_time'})
 
 def validate_medication_data(data):
     """Valida que los datos del medicamento tengan todos los campos requeridos"""
     if not data or 'medications' not in data:
         return False, 'Faltan datos requeridos'
     
-    required_med_fields = ['medication_id', 'start_date', 'interval', 'schedules']
-    required_schedule_fields = ['schedule_id', 'scheduled_time']
-    
     for medication in data['medications']:
-        if not all(key in medication for key in required_med_fields):
+        if not _REQUIRED_MED_FIELDS.issubset(medication):
             return False, 'Faltan campos requeridos en el medicamento'
         
         for schedule in medication['schedules']:
-            if not all(key in schedule for key in required_schedule_fields):
+            if not _REQUIRED_SCHEDULE_FIELDS.issubset(schedule):
                 return False, 'Faltan campos requeridos en el schedule'
     
     return True, None
 
+@lru_cache(maxsize=128)
+def parse_interval(interval_str):
+    """Convierte un intervalo HH:MM:SS a (horas del intervalo, tomas por día)"""
+    hours, minutes, seconds = map(int, interval_str.split(':'))
+    interval_hours = hours + (minutes / 60) + (seconds / 3600)
+    return interval_hours, int(24 / interval_hours)
+
+def calculate_time_diffs(intake_logs, base_time, interval_hours):
+    """Calcula el desfase en nanosegundos de cada toma respecto a su horario esperado"""
+    log_ns = parse_log_times([log['time'] for log in intake_logs])
+    base_ns = np.datetime64(base_time, 'ns').astype('int64')
+    interval_ns = int(round(interval_hours * 3.6e12))
+    
+    # Resto respecto al intervalo; fmod trunca el ciclo hacia cero, igual que int(horas / intervalo)
+    return np.fmod(log_ns - base_ns, interval_ns), log_ns
+
+def calculate_compliance_history(medication, schedule):
+    """Calcula el cumplimiento de cada toma con la misma regla que el entorno de RL"""
+    if not schedule.get('intake_logs'):
+        return []
+    
+    base_time = parse_time(schedule['scheduled_time'])
+    interval_hours, _ = parse_interval(medication['interval'])
+    diffs_ns, _ = calculate_time_diffs(schedule['intake_logs'], base_time, interval_hours)
+    
+    # Retraso respecto a la toma más cercana, en [-intervalo/2, intervalo/2): el resto
+    # de calculate_time_diffs es negativo para las tomas anteriores a base_time (un
+    # horario HH:MM:SS se fija a hoy) y quedaría cerca de -intervalo
+    interval_ns = int(round(interval_hours * 3.6e12))
+    half_interval_ns = interval_ns // 2
+    lateness_ns = (diffs_ns + half_interval_ns) % interval_ns - half_interval_ns
+    
+    return calculate_compliance(lateness_ns / 6e10).tolist()
+
 def calculate_future_schedules(medication, schedule, days=3):
     """Calcula los horarios futuros basados en el patrón de toma y compensa el desfase"""
     try:
@@ -59,56 +94,39 @@ def calculate_future_schedules(medication, schedule, days=3):
             return []
             
         base_time = parse_time(schedule['scheduled_time'])
-        interval_time = parse_time(medication['interval'])
-        interval_hours = interval_time.hour + (interval_time.minute / 60) + (interval_time.second / 3600)
-        takes_per_day = int(24 / interval_hours)
+        interval_hours, takes_per_day = parse_interval(medication['interval'])
+        interval_ns = int(round(interval_hours * 3.6e12))
         
-        # Calcular el desfase promedio basado en los logs
-        time_diffs = []
+        # Calcular el desfase promedio y la última toma basados en los logs (en ns)
         if schedule.get('intake_logs'):
-            sorted_logs = sorted(schedule['intake_logs'], key=lambda x: parse_time(x['time']))
-            
-            for log in sorted_logs:
-                log_time = parse_time(log['time'])
-                hours_since_base = (log_time - base_time).total_seconds() / 3600
-                cycle = int(hours_since_base / interval_hours)
-                expected_time = base_time + timedelta(hours=cycle * interval_hours)
-                time_diff = (log_time - expected_time).total_seconds() / 3600
-                time_diffs.append(time_diff)
-        
-        avg_adjustment = sum(time_diffs) / len(time_diffs) if time_diffs else 0
-        
-        # Obtener la última fecha de toma
-        last_intake_date = None
-        if schedule.get('intake_logs'):
-            last_intake = max(schedule['intake_logs'], key=lambda x: parse_time(x['time']))
-            last_intake_date = parse_time(last_intake['time'])
+            diffs_ns, log_ns = calculate_time_diffs(schedule['intake_logs'], base_time, interval_hours)
+            avg_adjustment_ns = diffs_ns.mean()
+            last_intake_ns = log_ns.max()
         else:
+            avg_adjustment_ns = 0
             last_intake_date = datetime.combine(
                 datetime.strptime(medication['start_date'], '%Y-%m-%d').date(),
                 base_time.time()
             )
+            last_intake_ns = np.datetime64(last_intake_date, 'ns').astype('int64')
         
         # Obtener schedule_ids disponibles
         available_schedule_ids = [s['schedule_id'] for s in medication['schedules']]
         if not available_schedule_ids:
             return []
         
-        # Calcular horarios futuros
-        future_schedules = []
-        current_datetime = last_intake_date
+        # Calcular horarios futuros: una toma por intervalo, desplazadas por el desfase promedio
+        offsets_ns = np.arange(takes_per_day, dtype=np.int64) * interval_ns
+        future_times_ns = last_intake_ns + offsets_ns + np.int64(round(avg_adjustment_ns))
+        future_times = pd.to_datetime(future_times_ns).strftime('%H:%M:%S')
         
-        for i in range(takes_per_day):
-            schedule_id = available_schedule_ids[i % len(available_schedule_ids)]
-            adjusted_time = current_datetime + timedelta(hours=avg_adjustment)
-            
-            future_schedules.append({
-                'schedule_id': schedule_id,
-                'scheduled_time': adjusted_time.strftime('%H:%M:%S')
-            })
-            current_datetime += timedelta(hours=interval_hours)
-        
-        return future_schedules
+        return [
+            {
+                'schedule_id': available_schedule_ids[i % len(available_schedule_ids)],
+                'scheduled_time': future_time
+            }
+            for i, future_time in enumerate(future_times)
+        ]
         
     except Exception as e:
         print(f"Error al calcular horarios futuros: {str(e)}")
@@ -120,13 +138,27 @@ def save_to_json(data, filename):
         dirpath = os.path.dirname(filename)
         if dirpath:  # Solo crea el directorio si no es vacío
             os.makedirs(dirpath, exist_ok=True)
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        Path(filename).write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         return True
     except Exception as e:
         print(f"Error al guardar archivo {filename}: {str(e)}")
         return False
 
+def run_training(total_timesteps):
+    """Entrena el agente compartido en segundo plano"""
+    global agent_trained
+    # training_executor tiene un solo hilo: los entrenamientos nunca se solapan.
+    # /process no espera: predice con la copia trazada de la política (ver SmartPillboxAgent._trace_policy)
+    model_path = agent.train(total_timesteps=total_timesteps)
+    mean_reward, std_reward = agent.evaluate()
+    agent_trained = True
+    
+    return {
+        'model_path': model_path,
+        'mean_reward': float(mean_reward),
+        'std_reward': float(std_reward)
+    }
+
 @app.route('/health', methods=['GET'])
 def health():
     """Endpoint de health check para saber si el servidor está disponible"""
@@ -134,9 +166,12 @@ def health():
 
 @app.route('/process', methods=['POST'])
 def process_data():
-    """Endpoint para procesar datos, entrenar y ajustar horarios"""
+    """Endpoint para procesar datos y ajustar horarios con el modelo ya entrenado"""
     try:
-        data = request.get_json()
+        try:
+            data = orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            data = None
         
         # Validar datos
         is_valid, error_msg = validate_medication_data(data)
@@ -148,23 +183,17 @@ def process_data():
             return jsonify({'error': 'Error al procesar los datos'}), 500
         
         # Preprocesar y preparar datos
-        training_data = processor.preprocess_data()
+        # (se pasan los datos de esta solicitud: el procesador es compartido entre hilos)
+        training_data, intake_times = processor.preprocess_data(data)
         sequences = processor.get_training_sequences(training_data)
         
         # Guardar datos procesados
-        if not save_to_json(sequences, 'processed_data.json'):
+        if not processor.save_processed_data(sequences, intake_times, 'processed_data.json'):
             return jsonify({'error': 'Error al guardar datos procesados'}), 500
         
-        # Iniciar entrenamiento
-        global agent
-        agent = SmartPillboxAgent()
-        model_path = agent.train(total_timesteps=10000)
-        
-        # Evaluar modelo
-        mean_reward, std_reward = agent.evaluate()
-        
         # Calcular horarios futuros
         response_data = []
+        pending_schedules = []
         for medication in data['medications']:
             if medication['schedules']:
                 schedule = medication['schedules'][0]
@@ -175,6 +204,18 @@ def process_data():
                         'medication_id': medication['medication_id'],
                         'future_schedules': future_times
                     })
+                    pending_schedules.append((medication, schedule))
+        
+        # Ajuste sugerido por el agente para todos los horarios en una sola predicción
+        if agent_trained and pending_schedules:
+            scheduled_times = [parse_time(schedule['scheduled_time']) for _, schedule in pending_schedules]
+            histories = [
+                calculate_compliance_history(medication, schedule)
+                for medication, schedule in pending_schedules
+            ]
+            adjustments = agent.adjust_schedule_batch(scheduled_times, histories)
+            for medication_data, (_, time_adjustment) in zip(response_data, adjustments):
+                medication_data['model_adjustment_minutes'] = round(time_adjustment, 2)
         
         # Guardar horarios futuros
         if not save_to_json(response_data, 'data/future_schedules.json'):
@@ -185,5 +226,52 @@ def process_data():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/train', methods=['POST'])
+def train_model():
+    """Endpoint para lanzar el entrenamiento del modelo en segundo plano"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'El cuerpo debe ser un objeto JSON'}), 400
+    
+    # Solo enteros JSON: se rechazan booleanos, decimales y cadenas
+    total_timesteps = data.get('total_timesteps', 10000)
+    if (
+        not isinstance(total_timesteps, int) or isinstance(total_timesteps, bool)
+        or not 0 < total_timesteps <= MAX_TOTAL_TIMESTEPS
+    ):
+        return jsonify({
+            'error': f'total_timesteps debe ser un entero entre 1 y {MAX_TOTAL_TIMESTEPS}'
+        }), 400
+    
+    with _jobs_lock:
+        # Descartar los trabajos terminados más antiguos para no guardar resultados sin límite
+        finished = [job_id for job_id, job in training_jobs.items() if job.done()]
+        for job_id in finished[:max(0, len(training_jobs) - MAX_TRAINING_JOBS + 1)]:
+            del training_jobs[job_id]
+        if len(training_jobs) >= MAX_TRAINING_JOBS:
+            return jsonify({'error': 'Demasiados entrenamientos en cola'}), 429
+        
+        job_id = uuid.uuid4().hex
+        training_jobs[job_id] = training_executor.submit(run_training, total_timesteps)
+    
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+@app.route('/train/<job_id>', methods=['GET'])
+def training_status(job_id):
+    """Endpoint para consultar el estado de un entrenamiento"""
+    with _jobs_lock:
+        job = training_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Entrenamiento no encontrado'}), 404
+    
+    if not job.done():
+        status = 'running' if job.running() else 'queued'
+        return jsonify({'job_id': job_id, 'status': status}), 200
+    
+    if job.exception() is not None:
+        return jsonify({'job_id': job_id, 'status': 'failed', 'error': str(job.exception())}), 200
+    
+    return jsonify({'job_id': job_id, 'status': 'done', **job.result()}), 200
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
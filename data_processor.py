@@ -1,8 +1,66 @@
-import json
+import ciso8601
+import orjson
+import re
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime, time
+from functools import lru_cache
 import pandas as pd
 
+# Valor int64 de NaT y columnas en ns que pueden contenerlo (se guardan como null)
+_NAT_NS = np.iinfo(np.int64).min
+_NS_COLUMNS = ('scheduled_ns', 'start_date_ns', 'interval_ns')
+
+_ISO_RE = re.compile(r'^\d{4}-\d{2}-\d{2}T')
+
+@lru_cache(maxsize=4096)
+def _parse_iso(time_str):
+    """Convierte una fecha ISO completa a datetime sin zona horaria"""
+    # Descarta la zona horaria (Z u offset) conservando la hora local
+    return ciso8601.parse_datetime_as_naive(time_str)
+
+def parse_time(time_str):
+    """Convierte una cadena de tiempo a datetime"""
+    if not time_str:
+        return datetime.now()
+        
+    try:
+        # Si es fecha completa en formato ISO (con o sin Z)
+        if _ISO_RE.match(time_str):
+            return _parse_iso(time_str)
+            
+        # Si es solo hora (HH:MM:SS)
+        if len(time_str) == 8 and time_str[2] == ':' and time_str[5] == ':':
+            hour, minute, second = int(time_str[0:2]), int(time_str[3:5]), int(time_str[6:8])
+            return datetime.combine(datetime.now().date(), time(hour, minute, second))
+        if len(time_str.split(':')) == 3 and 'T' not in time_str:
+            hour, minute, second = map(int, time_str.split(':'))
+            return datetime.combine(datetime.now().date(), time(hour, minute, second))
+            
+        # Cualquier otro formato ISO (por ejemplo solo fecha)
+        dt = datetime.fromisoformat(time_str)
+        return dt.replace(tzinfo=None) if dt.tzinfo else dt
+        
+    except Exception as e:
+        print(f"Error al parsear tiempo: {time_str}, error: {str(e)}")
+        return datetime.now()
+
+def parse_log_times(time_strs):
+    """Convierte una lista de cadenas de tiempo a nanosegundos desde epoch (int64)"""
+    try:
+        # Camino vectorizado: todas las cadenas son ISO 8601 con la misma zona horaria
+        times = pd.to_datetime(time_strs, format='ISO8601')
+        if isinstance(times, pd.DatetimeIndex) and not times.hasnans:
+            # Igual que parse_time: se descarta la zona horaria conservando la hora local
+            if times.tz is not None:
+                times = times.tz_localize(None)
+            return times.values.astype('datetime64[ns]').view('i8')
+    except (ValueError, TypeError):
+        pass
+    
+    # Formatos mixtos o solo hora (HH:MM:SS): se parsea cada cadena distinta una sola vez
+    parsed = {time_str: parse_time(time_str) for time_str in set(time_strs)}
+    return np.array([parsed[t] for t in time_strs], dtype='datetime64[ns]').view('i8')
+
 class DataProcessor:
     """
     Clase para procesar datos de la base de datos y prepararlos para el modelo de RL
@@ -21,62 +79,90 @@ class DataProcessor:
             print(f"Error al cargar datos: {str(e)}")
             return False
     
-    def preprocess_data(self):
-        """Preprocesa los datos para el entrenamiento"""
-        if not self.data:
-            return None
+    def preprocess_data(self, data=None):
+        """
+        Preprocesa los datos para el entrenamiento en formato columnar: un
+        DataFrame con una fila por horario y todas las tomas en un solo
+        arreglo, indexado por logs_offset/logs_count
+        
+        Args:
+            data: JSON recibido; si no se indica se usa el cargado con load_from_db
             
-        processed_data = []
+        Returns:
+            (processed_data, intake_times), o (None, None) si no hay datos
+        """
+        if data is None:
+            data = self.data
+        if not data:
+            return None, None
+            
+        medication_ids = []
+        schedule_ids = []
+        scheduled_times = []
+        start_dates = []
+        intervals = []
+        logs_count = []
+        log_times = []
         
-        for medication in self.data['medications']:
+        for medication in data['medications']:
             for schedule in medication['schedules']:
                 # Extraer datos básicos
-                schedule_data = {
-                    'medication_id': medication['medication_id'],
-                    'schedule_id': schedule['schedule_id'],
-                    'scheduled_time': schedule['scheduled_time'],
-                    'start_date': medication['start_date'],
-                    'interval': medication['interval']
-                }
-                
-                # Procesar logs de toma
-                if 'intake_logs' in schedule:
-                    schedule_data['intake_logs'] = schedule['intake_logs']
-                else:
-                    schedule_data['intake_logs'] = []
+                medication_ids.append(medication['medication_id'])
+                schedule_ids.append(schedule['schedule_id'])
+                scheduled_times.append(schedule['scheduled_time'])
+                start_dates.append(medication['start_date'])
+                intervals.append(medication['interval'])
                 
-                processed_data.append(schedule_data)
+                # Procesar logs de toma (se omiten los que no traen hora)
+                times = [log['time'] for log in schedule.get('intake_logs') or [] if log and log.get('time')]
+                logs_count.append(len(times))
+                log_times.extend(times)
+        
+        logs_count = np.array(logs_count, dtype=np.int64)
+        
+        # Tiempos en nanosegundos (int64): horarios e intervalos como duración desde medianoche.
+        # Se conservan las cadenas originales; los valores que no se pueden convertir quedan en NaT
+        processed_data = pd.DataFrame({
+            'medication_id': pd.Categorical(medication_ids),  # Pocos valores distintos, uno por medicamento
+            'schedule_id': schedule_ids,
+            'scheduled_time': scheduled_times,
+            'scheduled_ns': pd.to_timedelta(scheduled_times, errors='coerce').values.astype('timedelta64[ns]').view('i8'),
+            'start_date': start_dates,
+            'start_date_ns': pd.to_datetime(start_dates, format='ISO8601', errors='coerce').values.astype('datetime64[ns]').view('i8'),
+            'interval': intervals,
+            'interval_ns': pd.to_timedelta(intervals, errors='coerce').values.astype('timedelta64[ns]').view('i8'),
+            'logs_offset': np.cumsum(logs_count) - logs_count,
+            'logs_count': logs_count
+        })
+        
+        # Todas las tomas en un arreglo contiguo: las de la fila i son intake_times[offset:offset + count]
+        # (mismo criterio que /process: se descarta la zona horaria conservando la hora local)
+        intake_times = parse_log_times(log_times)
         
         self.processed_data = processed_data
-        return processed_data
+        return processed_data, intake_times
     
     def get_training_sequences(self, data):
-        """Genera secuencias de entrenamiento"""
-        if not data:
-            return []
-            
-        sequences = []
-        
-        for schedule in data:
-            # Crear secuencia base
-            sequence = {
-                'medication_id': schedule['medication_id'],
-                'schedule_id': schedule['schedule_id'],
-                'scheduled_time': schedule['scheduled_time'],
-                'start_date': schedule['start_date'],
-                'interval': schedule['interval'],
-                'intake_logs': schedule['intake_logs']
-            }
+        """Genera secuencias de entrenamiento (los datos ya están en formato columnar)"""
+        if data is None:
+            return pd.DataFrame()
             
-            sequences.append(sequence)
-        
-        return sequences
+        return data
     
-    def save_processed_data(self, data, output_file):
-        """Guarda los datos procesados en un archivo JSON"""
+    def save_processed_data(self, data, intake_times, output_file):
+        """Guarda los datos procesados y el arreglo de tomas que les corresponde en un archivo JSON"""
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            schedules = data.to_dict(orient='list')
+            # NaT se guarda como null en lugar del entero mínimo de int64
+            for column in _NS_COLUMNS:
+                if column in schedules:
+                    schedules[column] = [None if value == _NAT_NS else value for value in schedules[column]]
+            
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(
+                    {'schedules': schedules, 'intake_times': intake_times},
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+                ))
             return True
         except Exception as e:
             print(f"Error al guardar datos: {str(e)}")
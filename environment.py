@@ -1,8 +1,49 @@
-import gym
+import gymnasium as gym
 import numpy as np
-from gym import spaces
-from datetime import datetime, timedelta
+from gymnasium import spaces
+from stable_baselines3.common.vec_env import VecEnv
+from datetime import datetime
 import json
+import time
+
+# Límites del espacio de observación para el max_time_shift por defecto (compartidos entre entornos)
+_DEFAULT_MAX_TIME_SHIFT = 120
+_DEFAULT_OBS_LOW = np.array([-_DEFAULT_MAX_TIME_SHIFT, 0, 0], dtype=np.float32)
+_DEFAULT_OBS_HIGH = np.array([_DEFAULT_MAX_TIME_SHIFT, 1, 24], dtype=np.float32)
+
+def _observation_bounds(max_time_shift):
+    """Devuelve (low, high) del espacio de observación; solo crea arreglos si el máximo no es el de por defecto"""
+    if max_time_shift == _DEFAULT_MAX_TIME_SHIFT:
+        return _DEFAULT_OBS_LOW, _DEFAULT_OBS_HIGH
+    return (
+        np.array([-max_time_shift, 0, 0], dtype=np.float32),
+        np.array([max_time_shift, 1, 24], dtype=np.float32)
+    )
+
+def calculate_compliance(time_diff):
+    """
+    Cumplimiento de una toma (o de un arreglo de tomas) según su diferencia
+    en minutos: 1.0 dentro de 30 minutos y después decae hasta 0 a las 2 horas
+    """
+    abs_diff = np.abs(time_diff)
+    return np.where(abs_diff < 30, 1.0, np.maximum(0, 1 - abs_diff / 120))
+
+def calculate_rewards(time_diff, reward_on_time, penalty_missed):
+    """
+    Versión por lotes de SmartPillboxEnv.calculate_reward: evalúa los tres
+    tramos sobre un arreglo de diferencias de tiempo con máscaras, sin ramas
+    """
+    abs_diff = np.abs(np.asarray(time_diff, dtype=np.float32))
+    on_time = abs_diff < 15
+    missed = abs_diff >= 60
+    acceptable = ~(on_time | missed)
+    
+    rewards = (
+        reward_on_time * on_time
+        + reward_on_time * (1 - abs_diff / 60) * acceptable
+        + penalty_missed * (abs_diff / 120) * missed
+    )
+    return rewards.astype(np.float32, copy=False)
 
 class SmartPillboxEnv(gym.Env):
     """
@@ -33,27 +74,39 @@ class SmartPillboxEnv(gym.Env):
         )
         
         # Espacio de observación: [diferencia_tiempo_actual, histórico_tomas, hora_del_día]
-        self.observation_space = spaces.Box(
-            low=np.array([-self.config['max_time_shift'], 0, 0]),
-            high=np.array([self.config['max_time_shift'], 1, 24]),
-            dtype=np.float32
-        )
+        obs_low, obs_high = _observation_bounds(self.config['max_time_shift'])
+        self.observation_space = spaces.Box(low=obs_low, high=obs_high, dtype=np.float32)
         
         self.reset()
     
-    def reset(self):
-        """Reinicia el entorno al inicio de un nuevo episodio"""
+    def reset(self, seed=None, options=None):
+        """Reinicia el entorno al inicio de un nuevo episodio; devuelve (observación, info) como en gymnasium"""
+        super(SmartPillboxEnv, self).reset(seed=seed)
         self.current_episode = 0
-        self.intake_history = []
+        # Últimos 5 valores de cumplimiento (búfer circular) y su suma acumulada
+        self.intake_history = [0.0] * 5
+        self._history_sum = 0.0
         
         # Estado inicial
         self.current_state = np.array([0, 0.5, 12], dtype=np.float32)  # No hay diferencia, historial neutro, mediodía
 
-        # Inicializa los tiempos para el primer episodio
-        self.scheduled_time = datetime.now()
-        self.actual_intake_time = self.scheduled_time  # O pon aquí la lógica que desees
+        # Inicializa los tiempos para el primer episodio (minutos desde epoch)
+        self._sched_min = time.time() / 60
+        self._actual_min = self._sched_min  # O pon aquí la lógica que desees
+        
+        # La toma real no cambia durante el episodio: su hora del día se calcula una vez
+        actual_intake_time = self.actual_intake_time
+        self._hour_of_day = actual_intake_time.hour + actual_intake_time.minute / 60.0
 
-        return self.current_state
+        return self.current_state, {}
+    
+    @property
+    def scheduled_time(self):
+        return datetime.fromtimestamp(self._sched_min * 60)
+    
+    @property
+    def actual_intake_time(self):
+        return datetime.fromtimestamp(self._actual_min * 60)
     
     def step(self, action):
         """
@@ -65,51 +118,163 @@ class SmartPillboxEnv(gym.Env):
         Returns:
             observation: El nuevo estado
             reward: La recompensa obtenida
-            done: Si el episodio ha terminado
+            terminated: Si el episodio ha terminado
+            truncated: Siempre False (el fin del episodio ya se indica en terminated,
+                igual que los dones de VectorizedSmartPillboxEnv)
             info: Información adicional
         """
         # Aplicar ajuste de tiempo
         time_adjustment = float(action[0])
         
-        # Ajustar el horario
-        adjusted_time = self.scheduled_time + timedelta(minutes=time_adjustment)
+        # Ajustar el horario (en minutos, sin crear datetime/timedelta por paso)
+        adjusted_min = self._sched_min + time_adjustment
         
         # Calcular diferencia entre tiempo ajustado y tiempo real de toma
-        time_diff = (self.actual_intake_time - adjusted_time).total_seconds() / 60
+        time_diff = self._actual_min - adjusted_min
         
         # Actualizar historial
-        compliance = 1.0 if abs(time_diff) < 30 else max(0, 1 - (abs(time_diff) / 120))
-        self.intake_history.append(compliance)
+        compliance = float(calculate_compliance(time_diff))
+        slot = self.current_episode % 5
+        self._history_sum += compliance - self.intake_history[slot]
+        self.intake_history[slot] = compliance
         
         # Calcular recompensa
         reward = self.calculate_reward(time_diff, compliance)
         
         # Actualizar estado
-        hour_of_day = self.actual_intake_time.hour + self.actual_intake_time.minute / 60.0
-        history_factor = np.mean(self.intake_history[-5:]) if len(self.intake_history) >= 5 else 0.5
+        hour_of_day = self._hour_of_day
+        history_factor = self._history_sum / 5 if self.current_episode >= 4 else 0.5
         self.current_state = np.array([time_diff, history_factor, hour_of_day], dtype=np.float32)
         
         # Verificar si el episodio ha terminado
         self.current_episode += 1
         done = self.current_episode >= self.config['max_episodes']
         
+        # Los tiempos se convierten a datetime solo aquí, al construir el info
         info = {
-            'scheduled_time': self.scheduled_time,
-            'adjusted_time': adjusted_time,
-            'actual_intake_time': self.actual_intake_time,
+            'scheduled_time': datetime.fromtimestamp(self._sched_min * 60),
+            'adjusted_time': datetime.fromtimestamp(adjusted_min * 60),
+            'actual_intake_time': datetime.fromtimestamp(self._actual_min * 60),
             'compliance': compliance
         }
         
-        return self.current_state, reward, done, info
+        return self.current_state, reward, done, False, info
     
     def calculate_reward(self, time_diff, compliance):
         """Calcula la recompensa basada en la diferencia de tiempo y el cumplimiento"""
-        if abs(time_diff) < 15:
+        abs_diff = abs(time_diff)
+        if abs_diff < 15:
             # Toma casi perfecta
             return self.config['reward_on_time']
-        elif abs(time_diff) < 60:
+        elif abs_diff < 60:
             # Toma aceptable
-            return self.config['reward_on_time'] * (1 - abs(time_diff) / 60)
+            return self.config['reward_on_time'] * (1 - abs_diff / 60)
         else:
             # Toma muy retrasada o adelantada
-            return self.config['penalty_missed'] * (abs(time_diff) / 120)
\ No newline at end of file
+            return self.config['penalty_missed'] * (abs_diff / 120)
+
+class VectorizedSmartPillboxEnv(VecEnv):
+    """
+    Versión vectorizada de SmartPillboxEnv: mantiene el estado de todos los
+    entornos en un único arreglo (num_envs, 3) y ejecuta step/reset como
+    operaciones de NumPy, sin subprocesos ni bucles de Python por entorno.
+    """
+    
+    def __init__(self, num_envs=8, config=None):
+        # Misma configuración por defecto que SmartPillboxEnv
+        self.config = {
+            'max_time_shift': 120,
+            'reward_on_time': 10,
+            'penalty_missed': -20,
+            'max_episodes': 100
+        }
+        
+        if config:
+            self.config.update(config)
+        
+        # Espacios de gymnasium: el VecEnv se entrega directo a SB3 (>= 2.0), que no los convierte
+        max_shift = self.config['max_time_shift']
+        action_space = spaces.Box(low=-max_shift, high=max_shift, shape=(1,), dtype=np.float32)
+        obs_low, obs_high = _observation_bounds(max_shift)
+        observation_space = spaces.Box(low=obs_low, high=obs_high, dtype=np.float32)
+        self.render_mode = None
+        super(VectorizedSmartPillboxEnv, self).__init__(num_envs, observation_space, action_space)
+        
+        # Estado por entorno: [diferencia_tiempo_actual, histórico_tomas, hora_del_día]
+        self.state = np.empty((num_envs, 3), dtype=np.float32)
+        # Diferencia en minutos entre la toma real y la programada
+        self.intake_offset = np.zeros(num_envs, dtype=np.float32)
+        # Hora del día de la toma real, fija durante el episodio
+        self.intake_hour = np.zeros(num_envs, dtype=np.float32)
+        # Últimos 5 valores de cumplimiento de cada entorno
+        self.intake_history = np.zeros((num_envs, 5), dtype=np.float32)
+        self.current_episode = np.zeros(num_envs, dtype=np.int64)
+        self.actions = None
+        
+        self._reset_envs(np.ones(num_envs, dtype=bool))
+    
+    def _reset_envs(self, mask):
+        """Reinicia únicamente los entornos indicados por la máscara"""
+        now = datetime.now()
+        self.current_episode[mask] = 0
+        self.intake_history[mask] = 0
+        self.intake_offset[mask] = 0
+        self.intake_hour[mask] = now.hour + now.minute / 60.0
+        # Igual que SmartPillboxEnv.reset: mediodía hasta el primer paso
+        self.state[mask] = (0, 0.5, 12)
+    
+    def reset(self):
+        """Reinicia todos los entornos y devuelve las observaciones iniciales"""
+        self._reset_envs(np.ones(self.num_envs, dtype=bool))
+        return self.state.copy()
+    
+    def step_async(self, actions):
+        self.actions = np.asarray(actions, dtype=np.float32).reshape(self.num_envs, -1)
+    
+    def step_wait(self):
+        """Ejecuta un paso en todos los entornos a la vez"""
+        # Diferencia entre la toma real y el horario ajustado
+        time_diff = self.intake_offset - self.actions[:, 0]
+        
+        # Actualizar historial
+        compliance = calculate_compliance(time_diff)
+        self.intake_history[np.arange(self.num_envs), self.current_episode % 5] = compliance
+        
+        # Calcular recompensa (mismos tramos que SmartPillboxEnv.calculate_reward)
+        rewards = calculate_rewards(time_diff, self.config['reward_on_time'], self.config['penalty_missed'])
+        
+        # Actualizar estado
+        self.current_episode += 1
+        self.state[:, 0] = time_diff
+        self.state[:, 1] = np.where(self.current_episode >= 5, self.intake_history.mean(axis=1), 0.5)
+        self.state[:, 2] = self.intake_hour
+        
+        # Verificar qué episodios han terminado y reiniciarlos
+        dones = self.current_episode >= self.config['max_episodes']
+        infos = [{'compliance': float(c)} for c in compliance]
+        for idx in np.flatnonzero(dones):
+            infos[idx]['terminal_observation'] = self.state[idx].copy()
+        if dones.any():
+            self._reset_envs(dones)
+        
+        return self.state.copy(), rewards, dones, infos
+    
+    def close(self):
+        pass
+    
+    def seed(self, seed=None):
+        # El entorno es determinista, no hay generador que sembrar
+        return [None for _ in range(self.num_envs)]
+    
+    def get_attr(self, attr_name, indices=None):
+        return [getattr(self, attr_name) for _ in self._get_indices(indices)]
+    
+    def set_attr(self, attr_name, value, indices=None):
+        setattr(self, attr_name, value)
+    
+    def env_method(self, method_name, *method_args, indices=None, **method_kwargs):
+        method = getattr(self, method_name)
+        return [method(*method_args, **method_kwargs) for _ in self._get_indices(indices)]
+    
+    def env_is_wrapped(self, wrapper_class, indices=None):
+        return [False for _ in self._get_indices(indices)]